@@ -3,16 +3,23 @@
 # Streamlit UI to upload multiple invoice PDFs, parse them, preview the table,
 # and download a single Excel file (one sheet) with a header row.
 
+import hashlib
 import io
+import multiprocessing
+import os
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 import streamlit as st
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+import xlsxwriter
 
-from parse_logic import parse_pdf_bytes, HEADERS
+from parse_logic import empty_row, parse_worker, HEADERS
 
 
 # ------------------------------
@@ -32,41 +39,170 @@ def extract_invoice_id(filename: str):
     return match.group(1) if match else filename   # fallback to entire filename
 
 
-st.set_page_config(page_title="Invoice Processor – Freight A→Z", layout="wide")
-st.title("📦 Invoice Processor – Freight A→Z")
-st.caption("Invoice Date · CAD aware · kg/cbm chargeable (multi-PDF uploader)")
+# ------------------------------
+# Helper: content-addressed parse cache
+# ------------------------------
+CACHE_MAX_ENTRIES = 256
+
+
+@st.cache_resource(show_spinner=False)
+def _parse_cache() -> Tuple["OrderedDict[str, tuple]", threading.Lock]:
+    """
+    Process-wide LRU of parse_worker results, keyed on a hash of the PDF bytes.
+    Survives reruns, so re-uploading the same invoice skips extraction and regex.
+    Shared by every session's script thread → only touch it under the lock.
+    """
+    return OrderedDict(), threading.Lock()
+
 
-with st.expander("How it works", expanded=False):
-    st.markdown(
-        "- Upload one or more **PDF** invoices.\n"
-        "- The app parses weights, volume, chargeable (KG/CBM), cartons, currency, subtotal, and freight lines (Air/Ocean).\n"
-        "- Review the extracted table.\n"
-        "- Click **Download Excel** to export `Invoice_Summary.xlsx`."
-    )
+def _cache_get(h: str) -> Optional[tuple]:
+    cache, lock = _parse_cache()
+    with lock:
+        result = cache.get(h)
+        if result is not None:
+            cache.move_to_end(h)
+        return result
 
-uploaded = st.file_uploader("Upload invoice PDFs", type=["pdf"], accept_multiple_files=True)
 
-if uploaded:
-    rows = []
-    log  = []
+def _cache_put(h: str, result: tuple) -> None:
+    cache, lock = _parse_cache()
+    with lock:
+        cache[h] = result
+        cache.move_to_end(h)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+
+def _pdf_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# ------------------------------
+# Helper: shared worker pool for large batches
+# ------------------------------
+# Below this many cache misses, parsing inline beats the pool's IPC overhead
+# (PyMuPDF takes a few ms per invoice).
+PARALLEL_MIN_MISSES = 8
+
 
-    with st.spinner("Parsing invoices..."):
-        for f in uploaded:
-            try:
-                data = f.read()
+@st.cache_resource(show_spinner=False)
+def _parse_pool() -> ProcessPoolExecutor:
+    """
+    One process pool for the whole server, reused across reruns and sessions
+    so workers are only started once. "spawn", not Linux's default fork:
+    forking Streamlit's multi-threaded server can deadlock the child. Spawned
+    workers re-import this script as __mp_main__, so the UI lives in main().
+    """
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                               mp_context=multiprocessing.get_context("spawn"))
 
-                # 🔥 Extract clean invoice ID (supports ending letter)
-                invoice_id = extract_invoice_id(f.name)
 
-                # Pass invoice_id instead of full filename
-                row = parse_pdf_bytes(data, filename=invoice_id)
+def _parse_uploads(uploaded) -> Tuple[List[str], List[str], Dict[str, tuple]]:
+    """
+    Clean invoice IDs and content hashes per upload, plus hash → (row, err).
+    Only PDFs not parsed before are parsed; many misses go to the pool.
+    """
+    ids     = []
+    hashes  = []
+    done    = {}   # hash → (row, err), kept at lookup time for this run
+    misses  = {}   # hash → (invoice_id, data)
+    for f in uploaded:
+        # 🔥 Extract clean invoice ID (supports ending letter).
+        # getvalue() hands back the upload's buffer without copying it and,
+        # unlike read(), doesn't depend on the stream position.
+        invoice_id, data = extract_invoice_id(f.name), f.getvalue()
+        h = _pdf_hash(data)
+        ids.append(invoice_id)
+        hashes.append(h)
+        if h in done or h in misses:
+            continue
+        hit = _cache_get(h)
+        if hit is not None:
+            done[h] = hit
+        else:
+            misses[h] = (invoice_id, data)
+
+    if len(misses) < PARALLEL_MIN_MISSES:
+        for h, item in misses.items():
+            done[h] = parse_worker(item)   # never raises
+            _cache_put(h, done[h])
+        return ids, hashes, done
+
+    # Each PDF is CPU-bound and independent → parse them in parallel, and
+    # collect in completion order so one slow file doesn't hold up the rest
+    pool    = _parse_pool()
+    pending = {pool.submit(parse_worker, item): h for h, item in misses.items()}
+    for fut in as_completed(pending):
+        h = pending[fut]
+        try:
+            done[h] = fut.result()
+            _cache_put(h, done[h])
+        except Exception as e:   # e.g. BrokenProcessPool if a worker died
+            if isinstance(e, BrokenProcessPool):
+                _parse_pool.clear()   # the next run starts a fresh pool
+            # Reported for this run only, never cached
+            done[h] = (empty_row(), str(e))
+    return ids, hashes, done
 
-                # Overwrite Filename field to ensure only clean ID is kept
-                row["Filename"] = invoice_id
 
-                rows.append(row)
+# ------------------------------
+# Helper: DataFrame → Invoice_Summary.xlsx bytes (one sheet + header row)
+# ------------------------------
+def build_excel(df: pd.DataFrame) -> bytes:
+    # Autosize columns from the DataFrame (vectorized str.len, missing cells
+    # skipped)
+    widths = [
+        min(max(len(col), int(df[col].astype("string").str.len().fillna(0).max())) + 2, 60)
+        for col in HEADERS
+    ]
+
+    # Build Excel in-memory with xlsxwriter (in_memory: no temp files; cells
+    # are held until the workbook closes, which is fine for one summary sheet)
+    buf = io.BytesIO()
+    with xlsxwriter.Workbook(buf, {"in_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"}) as wb:
+        ws = wb.add_worksheet("Invoice_Summary")
+        for i, width in enumerate(widths):
+            ws.set_column(i, i, width)
+
+        ws.write_row(0, 0, HEADERS)
+        cells = df.astype(object).where(df.notna(), None)
+        for i, r in enumerate(cells.itertuples(index=False, name=None), start=1):
+            ws.write_row(i, 0, r)
+    return buf.getvalue()
+
+
+def main() -> None:
+    st.set_page_config(page_title="Invoice Processor – Freight A→Z", layout="wide")
+    st.title("📦 Invoice Processor – Freight A→Z")
+    st.caption("Invoice Date · CAD aware · kg/cbm chargeable (multi-PDF uploader)")
+
+    with st.expander("How it works", expanded=False):
+        st.markdown(
+            "- Upload one or more **PDF** invoices.\n"
+            "- The app parses weights, volume, chargeable (KG/CBM), cartons, currency, subtotal, and freight lines (Air/Ocean).\n"
+            "- Review the extracted table.\n"
+            "- Click **Download Excel** to export `Invoice_Summary.xlsx`."
+        )
+
+    uploaded = st.file_uploader("Upload invoice PDFs", type=["pdf"], accept_multiple_files=True)
+
+    if uploaded:
+        cols = {col: [] for col in HEADERS}   # column-oriented → one DataFrame build
+        log  = []
+        batch_ts = datetime.now()             # one "processed at" time per batch
+
+        with st.spinner("Parsing invoices..."):
+            ids, hashes, done = _parse_uploads(uploaded)
+
+            for invoice_id, h in zip(ids, hashes):
+                row, err = done[h]
+                for col in HEADERS:
+                    cols[col].append(row.get(col))
 
                 # Logging
+                if err is not None:
+                    log.append(f"✗ {invoice_id} | error: {err}")
+                    continue
                 log.append(
                     f"✓ {invoice_id} | "
                     f"{row.get('Invoice_Date') or '—'} | "
@@ -75,68 +211,34 @@ if uploaded:
                     f"{('(' + str(row.get('Freight_Amount')) + ')') if row.get('Freight_Amount') is not None else ''}"
                 )
 
-            except Exception as e:
-                # use clean ID even on fail
-                invoice_id = extract_invoice_id(f.name)
-
-                rows.append({
-                    "Timestamp": datetime.now(),
-                    "Filename": invoice_id,
-                    "Invoice_Date": None, "Currency": None, "Shipper": None,
-                    "Weight_KG": None, "Volume_M3": None, "Chargeable_KG": None,
-                    "Chargeable_CBM": None, "Packages": None, "Subtotal": None,
-                    "Freight_Mode": None, "Freight_Amount": None
-                })
-                log.append(f"✗ {invoice_id} | error: {e}")
-
-    # Build DataFrame and enforce column order
-    df = pd.DataFrame(rows)
-    for col in HEADERS:
-        if col not in df.columns:
-            df[col] = None
-    df = df[HEADERS]
-
-    st.subheader("Preview")
-    st.dataframe(df, use_container_width=True)
-
-    with st.expander("Parse log"):
-        st.write("\n".join(log))
-
-    # Build Excel in-memory
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Invoice_Summary"
-
-    for r in dataframe_to_rows(df, index=False, header=True):
-        ws.append(r)
-
-    # Autosize columns
-    for col in ws.columns:
-        max_len = 0
-        col_letter = col[0].column_letter
-        for cell in col:
-            try:
-                if cell.value is None:
-                    continue
-                max_len = max(max_len, len(str(cell.value)))
-            except Exception:
-                pass
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 60)
+        # Same bytes may arrive under another name → keep this upload's ID
+        cols["Timestamp"] = [batch_ts] * len(ids)
+        cols["Filename"]  = ids
 
-    # Save Excel to memory buffer
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
+        # Build DataFrame (column order follows HEADERS)
+        df = pd.DataFrame(cols, columns=HEADERS)
+
+        # None sentinels leave numeric columns as object → use nullable dtypes
+        num_cols = ["Weight_KG", "Volume_M3", "Chargeable_KG", "Chargeable_CBM", "Subtotal", "Freight_Amount"]
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, errors="coerce").astype("Float64")
+        df["Packages"] = df["Packages"].astype("Int64")
+
+        st.subheader("Preview")
+        st.dataframe(df, use_container_width=True)
 
-    st.download_button(
-        label="⬇️ Download Excel (Invoice_Summary.xlsx)",
-        data=buf,
-        file_name="Invoice_Summary.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+        with st.expander("Parse log"):
+            st.write("\n".join(log))
 
-else:
-    st.info("Upload one or more **PDF** files to begin.")
+        st.download_button(
+            label="⬇️ Download Excel (Invoice_Summary.xlsx)",
+            data=build_excel(df),
+            file_name="Invoice_Summary.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
 
+    else:
+        st.info("Upload one or more **PDF** files to begin.")
 
 
+if __name__ == "__main__":
+    main()
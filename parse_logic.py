@@ -4,11 +4,9 @@
 # Accepts raw PDF bytes (so it works with Streamlit's in-memory uploads).
 
 import re
-from io import BytesIO
-from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Set, Tuple
 
-import pdfplumber
+import pymupdf
 
 
 # ── headers expected by the Excel/DF ─────────────────────────
@@ -21,6 +19,13 @@ HEADERS = [
     "Freight_Mode", "Freight_Amount",
 ]
 
+# all-None row; copied for failure rows instead of rebuilding the literal
+_EMPTY_ROW = {h: None for h in HEADERS}
+
+
+def empty_row() -> Dict[str, Any]:
+    return _EMPTY_ROW.copy()
+
 # ── regex patterns (ported from your watcher script) ─────────
 SHIPPER_PAT   = re.compile(r"SHIPPER\s+(.+?)\s+CONSIGNEE", re.I | re.S)
 INVOICE_DATE  = re.compile(r"INVOICE\s+DATE\s+([0-9]{1,2}[A-Za-z\- ]+[0-9]{2,4})", re.I)
@@ -43,105 +48,210 @@ AIR_FRT_PAT   = re.compile(r"AIR\s+FREIGHT\s+(?:([A-Z]{3})\s+)?([\d,]+\.\d{2})",
 OCEAN_FRT_PAT = re.compile(r"(?:OCEAN|SEA)\s+FREIGHT\s+(?:([A-Z]{3})\s+)?([\d,]+\.\d{2})", re.I)
 
 CURRENCY_ANY  = re.compile(r"\b(CAD|CDN|C\$)\b", re.I)
+WS_RUN        = re.compile(r"\s+")
+
+# Invoice metadata lives on the first page(s) ~always; only read further when
+# those pages don't settle every field (see _labels_settled).
+FIRST_PAGES = 2
+
+# ── single-pass label scan ───────────────────────────────────
+# One alternation over the keyword each labelled pattern starts with. A single
+# finditer pass finds every candidate; the full pattern is then matched in
+# place, instead of re-scanning the whole text once per field.
+LABEL_PAT = re.compile(
+    r"(?P<inv_date>INVOICE\s+DATE)"
+    r"|(?P<shipper>SHIPPER)"
+    r"|(?P<chargeable>CHARGEABLE)"
+    r"|(?P<subtotal>SUBTOTAL)"
+    r"|(?P<air>AIR\s+FREIGHT)"
+    r"|(?P<ocean>(?:OCEAN|SEA)\s+FREIGHT)", re.I)
+
+LABELLED = {
+    "inv_date"  : INVOICE_DATE,
+    "shipper"   : SHIPPER_PAT,
+    "chargeable": CHARGEABLE_LINE,
+    "subtotal"  : SUBTOTAL_PAT,
+    "air"       : AIR_FRT_PAT,
+    "ocean"     : OCEAN_FRT_PAT,
+}
+
+
+# weight unit (lower-cased regex group) → kg factor
+_UNIT_KG = {"kg": 1.0, "kgs": 1.0, "lb": 0.453592}
 
 
 def _f(s: Optional[str]) -> Optional[float]:
+    # Regex groups are already str without surrounding whitespace
     if s is None:
         return None
-    return float(str(s).replace(",", "").strip())
+    return float(s.replace(",", ""))
 
 
 def _to_kg(val: float, unit: str) -> float:
-    return val if unit.lower().startswith("kg") else val * 0.453592
+    return val * _UNIT_KG[unit.lower()]
 
 
-def _extract_full_text(pdf_bytes: bytes) -> str:
-    with pdfplumber.open(BytesIO(pdf_bytes)) as pdf:
-        return "\n".join(p.extract_text() or "" for p in pdf.pages)
+def _scan_labels(full: str) -> Tuple[Dict[str, "re.Match[str]"], Set[str]]:
+    """
+    First match of every LABELLED pattern, found in one pass over the text.
+    Equivalent to calling .search() per pattern, since each can only match
+    where its keyword starts.
+    Also returns the keys whose keyword occurred earlier without matching; on
+    truncated text such a hit might still match once more text follows.
+    """
+    found: Dict[str, "re.Match[str]"] = {}
+    missed: Set[str] = set()
+    labelled, total = LABELLED, len(LABELLED)   # locals: looked up per anchor hit
+    for a in LABEL_PAT.finditer(full):
+        key = a.lastgroup
+        if key in found:
+            continue
+        m = labelled[key].match(full, a.start())
+        if m:
+            found[key] = m
+            if len(found) == total:
+                break
+        else:
+            missed.add(key)
+    return found, missed
+
+
+def _labels_settled(full: str, labels: Dict[str, "re.Match[str]"], missed: Set[str]) -> bool:
+    """
+    True when the labelled fields found in the leading pages are final.
+    Every field takes its first match, so a hit already found can't move.
+    Per FIRST_PAGES, the summary block sits on those pages, so:
+      - the first freight line found (air or ocean) settles the mode; a line
+        of the other mode on a later page is not looked for;
+      - a missing CHARGEABLE line means there is none (the detail row's
+        chargeable value stands).
+    Invoice date, shipper and subtotal must be present, the currency chain
+    must stop at a captured code or a CAD marker, and no keyword may have
+    failed to match (its match could continue past the page break).
+    """
+    if missed or any(k not in labels for k in ("inv_date", "shipper", "subtotal")):
+        return False
+    freight = labels.get("air") or labels.get("ocean")
+    if freight is None:
+        return False
+    # Currency: subtotal → freight code, then the CAD heuristic
+    return bool(labels["subtotal"].group(1) or freight.group(1)
+                or CURRENCY_ANY.search(full))
+
+
+def _extract_full_text(pdf_bytes: bytes) -> Tuple[str, Dict[str, "re.Match[str]"], Optional["re.Match[str]"]]:
+    """
+    Document text, its label scan and the detail-row (ROW_PAT) match. Only the
+    first FIRST_PAGES pages are read when they settle every field; otherwise
+    the remaining pages are extracted and appended.
+    """
+    # PyMuPDF reads straight from the in-memory bytes and is much faster than
+    # pdfplumber/pdfminer for plain-text extraction.
+    doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        n = len(doc)
+        full = "\n".join(doc[i].get_text("text") for i in range(min(n, FIRST_PAGES)))
+        labels, missed = _scan_labels(full)
+        settled = n <= FIRST_PAGES or _labels_settled(full, labels, missed)
+
+        # A detail row further on would override the KG/M3/CTN fallbacks, so
+        # a missing row also means reading on
+        row_m = ROW_PAT.search(full) if settled else None
+        if n > FIRST_PAGES and row_m is None:
+            rest = "\n".join(doc[i].get_text("text") for i in range(FIRST_PAGES, n))
+            full = full + "\n" + rest
+            labels, _ = _scan_labels(full)
+            row_m = ROW_PAT.search(full)
+        return full, labels, row_m
+    finally:
+        doc.close()
 
 
 def parse_pdf_bytes(pdf_bytes: bytes, filename: str = "") -> Dict[str, Any]:
     """
     Parse a single PDF (bytes) and return a row dict with the expected HEADERS.
-    Never raises; on failure returns a minimal row with just Timestamp/Filename.
+    Never raises; on failure returns a minimal row with just Filename.
+    Timestamp is left None; the caller stamps one time for the whole batch.
     """
     try:
-        full = _extract_full_text(pdf_bytes)
+        full, labels, row_m = _extract_full_text(pdf_bytes)
+
+        # Cheap substring tests skip unanchored regexes whose keyword is absent
+        full_upper = full.upper()
+
+        # Money matches feed both currency detection and the amounts below
+        sub_m   = labels.get("subtotal")
+        air_m   = labels.get("air")
+        ocean_m = labels.get("ocean")
 
         # Invoice date
         inv_date = None
-        m = INVOICE_DATE.search(full)
+        m = labels.get("inv_date")
         if m:
             inv_date = m.group(1).strip()
 
         # Currency (default USD, CAD heuristics preserved)
         currency = "USD"
-        m = SUBTOTAL_PAT.search(full)
-        if m and m.group(1):
-            currency = m.group(1)
-        else:
-            m = AIR_FRT_PAT.search(full)
-            if m and m.group(1):
-                currency = m.group(1)
-            else:
-                m = OCEAN_FRT_PAT.search(full)
-                if m and m.group(1):
-                    currency = m.group(1)
-                elif CURRENCY_ANY.search(full):
-                    currency = "CAD"
+        if sub_m and sub_m.group(1):
+            currency = sub_m.group(1)
+        elif air_m and air_m.group(1):
+            currency = air_m.group(1)
+        elif ocean_m and ocean_m.group(1):
+            currency = ocean_m.group(1)
+        elif ("CAD" in full_upper or "CDN" in full_upper or "C$" in full_upper) \
+                and CURRENCY_ANY.search(full):
+            currency = "CAD"
 
         # Shipper
         shipper = None
-        m = SHIPPER_PAT.search(full)
+        m = labels.get("shipper")
         if m:
-            shipper = re.sub(r"\s+", " ", m.group(1).strip())
+            shipper = WS_RUN.sub(" ", m.group(1).strip())
 
         # Defaults
         w_kg = v_m3 = c_kg = c_cbm = packs = subtotal = mode = amount = None
 
         # Detail row (weight, volume, chargeable, cartons)
-        m = ROW_PAT.search(full)
+        m = row_m
         if m:
             w_val, w_unit, v_val, _, c_val, c_unit, packs = m.groups()
             w_kg  = _to_kg(_f(w_val), w_unit)
             v_m3  = _f(v_val)
             packs = int(packs)
-            if c_unit.lower() in ("kg", "kgs", "lb"):
+            if c_unit.lower() in _UNIT_KG:
                 c_kg  = _to_kg(_f(c_val), c_unit)
             else:
                 c_cbm = _f(c_val)
         else:
-            m = KG_PAT.search(full)
+            m = KG_PAT.search(full) if "KG" in full_upper else None
             if m: w_kg = _f(m.group(1))
-            m = M3_PAT.search(full)
+            m = M3_PAT.search(full) if "M3" in full_upper or "CBM" in full_upper else None
             if m: v_m3 = _f(m.group(1))
-            m = CTN_PAT.search(full)
+            m = CTN_PAT.search(full) if "CTN" in full_upper else None
             if m: packs = int(m.group(1))
 
         # CHARGEABLE line override
-        m = CHARGEABLE_LINE.search(full)
+        m = labels.get("chargeable")
         if m:
             val, unit = m.groups()
             val = _f(val); unit = unit.lower()
-            if unit in ("kg", "kgs", "lb"):
+            if unit in _UNIT_KG:
                 c_kg, c_cbm = _to_kg(val, unit), None
             else:
                 c_cbm, c_kg = val, None
 
         # Money
-        m = SUBTOTAL_PAT.search(full)
-        if m:
-            subtotal = _f(m.group(2))
+        if sub_m:
+            subtotal = _f(sub_m.group(2))
 
-        for pat in (AIR_FRT_PAT, OCEAN_FRT_PAT):
-            m = pat.search(full)
+        for mode_name, m in (("Air", air_m), ("Ocean", ocean_m)):
             if m:
-                mode   = "Air" if pat is AIR_FRT_PAT else "Ocean"
+                mode   = mode_name
                 amount = _f(m.group(2))
                 break
 
         return {
-            "Timestamp"       : datetime.now(),
+            "Timestamp"       : None,
             "Filename"        : filename,
             "Invoice_Date"    : inv_date,
             "Currency"        : currency,
@@ -157,18 +267,24 @@ def parse_pdf_bytes(pdf_bytes: bytes, filename: str = "") -> Dict[str, Any]:
         }
     except Exception:
         # Return minimal row so the app can still proceed
-        return {
-            "Timestamp"       : datetime.now(),
-            "Filename"        : filename,
-            "Invoice_Date"    : None,
-            "Currency"        : None,
-            "Shipper"         : None,
-            "Weight_KG"       : None,
-            "Volume_M3"       : None,
-            "Chargeable_KG"   : None,
-            "Chargeable_CBM"  : None,
-            "Packages"        : None,
-            "Subtotal"        : None,
-            "Freight_Mode"    : None,
-            "Freight_Amount"  : None,
-        }
+        row = empty_row()
+        row["Filename"] = filename
+        return row
+
+
+def parse_worker(item: Tuple[str, bytes]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    ProcessPoolExecutor entry point: parse one (invoice_id, pdf_bytes) pair.
+    Lives here (not in app.py) so worker processes can import it by reference.
+    Returns (row, error) where error is None on success.
+    """
+    invoice_id, data = item
+    try:
+        row, err = parse_pdf_bytes(data, filename=invoice_id), None
+    except Exception as e:
+        row = empty_row()
+        err = str(e)
+
+    # Overwrite Filename field to ensure only clean ID is kept
+    row["Filename"] = invoice_id
+    return row, err